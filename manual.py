@@ -3,6 +3,13 @@ import shutil
 import zipfile
 import os
 import csv
+import json
+import hashlib
+import io
+import mmap
+import multiprocessing
+import tarfile
+import time
 from lxml import etree
 from docx import Document
 from copy import deepcopy
@@ -31,18 +38,37 @@ COMPANY_NAME = "COMPANY"
 
 ######################################################
 
+############## OUTPUT ################################
+
+# Set to "zip" or "tar" to stream every document of the run into one
+# archive in RESULTS_DIR instead of writing separate files
+# Set to None to write separate files
+OUTPUT_BUNDLE = None
+
+# Number of processes rendering documents in parallel
+# Set to 1 to render in the main process
+WORKERS = 1
+
+######################################################
+
 
 # ---------------- CONFIG ----------------
 API_BASE_URL = "https://mariner.alphamrn.com/api"
 EMISSION_SOURCES_URL = f"{API_BASE_URL}/emission-sources"
 CSV_FILE = "vessels.csv"
 WORD_TEMPLATE = "model.docx" if SEEMP_VERSION_1_2 else "model_3.docx"
-TEMP_DIR = "temp_docx_extract"
 RESULTS_DIR = "results"
+TEMPLATE_CACHE_DIR = "template_cache"
+# Bump when precompile_template or the helpers it calls change,
+# so cached variants built by the old code are not reused
+TEMPLATE_CACHE_VERSION = 1
 
 if not os.path.exists(RESULTS_DIR):
     os.makedirs(RESULTS_DIR)
 
+if not os.path.exists(TEMPLATE_CACHE_DIR):
+    os.makedirs(TEMPLATE_CACHE_DIR)
+
 
 
 
@@ -66,14 +92,6 @@ def authenticate(username, password, base_url=API_BASE_URL, remember_me=False):
         print(response.text)
         return None
 
-token = authenticate(MYUSERNAME, MYPASSWORD)
-
-HEADERS = {
-    "Authorization": f"Bearer {token}",
-    "Accept": "application/json"
-}
-
-
 # ---------------- PLACEHOLDER MAPPING ----------------
 PLACEHOLDER_MAP = {
     "{{VSLNAME}}": "vesselName",
@@ -151,29 +169,67 @@ def recursive_replace(element, placeholders, visited=None):
 
 
 
-def process_docx(input_path, output_path, placeholders):
-    if os.path.exists(TEMP_DIR):
-        shutil.rmtree(TEMP_DIR)
-    os.makedirs(TEMP_DIR)
-    with zipfile.ZipFile(input_path, 'r') as zip_ref:
-        zip_ref.extractall(TEMP_DIR)
-    word_dir = os.path.join(TEMP_DIR, "word")
-    for root_dir, dirs, files in os.walk(word_dir):
-        for file in files:
-            if file.endswith(".xml"):
-                file_path = os.path.join(root_dir, file)
+class MappedTemplate(io.RawIOBase):
+    """
+    Read-only file object over a memory-mapped template archive.
+    Every worker maps the same file, so the OS shares the pages between
+    processes instead of each worker holding its own copy.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        else:
+            self.pos = len(self.map) + offset
+        return self.pos
+
+    def readinto(self, b):
+        # Copy straight from the mapping into the caller's buffer
+        n = max(0, min(len(b), len(self.map) - self.pos))
+        b[:n] = self.view[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def close(self):
+        self.view.release()
+        self.map.close()
+        super().close()
+
+
+def process_docx(input_path, output_path, placeholders, parts=None):
+    """
+    Replace placeholders in every XML part under word/.
+    If parts is given (see precompile_template), only those parts are parsed.
+    input_path and output_path may be paths or file objects; nothing is
+    extracted to disk, so several processes can render at the same time.
+    """
+    with zipfile.ZipFile(input_path, 'r') as zip_ref, zipfile.ZipFile(output_path, "w") as zipf:
+        for item in zip_ref.infolist():
+            data = zip_ref.read(item)
+            name = item.filename
+            if name.startswith("word/") and name.endswith(".xml") and (parts is None or name in parts):
                 parser = etree.XMLParser(remove_blank_text=False)
-                tree = etree.parse(file_path, parser)
-                root = tree.getroot()
+                root = etree.fromstring(data, parser)
                 recursive_replace(root, placeholders)
-                tree.write(file_path, encoding="UTF-8", xml_declaration=True)
-    with zipfile.ZipFile(output_path, "w") as zipf:
-        for root_dir, dirs, files in os.walk(TEMP_DIR):
-            for file in files:
-                file_path = os.path.join(root_dir, file)
-                arcname = os.path.relpath(file_path, TEMP_DIR)
-                zipf.write(file_path, arcname)
-    shutil.rmtree(TEMP_DIR)
+                data = etree.tostring(root, encoding="UTF-8", xml_declaration=True)
+            zipf.writestr(item, data)
 
 # ---------------- CSV UTILITIES ----------------
 def get_imos_for_company(csv_file, company_name=None, vessel_imo=None):
@@ -190,15 +246,17 @@ def get_imos_for_company(csv_file, company_name=None, vessel_imo=None):
     return imos
 
 # ---------------- API FETCH ----------------
-def get_vessel(imo):
+# With raw=True the undecoded JSON bytes are returned, which is what gets
+# handed to the rendering workers
+def get_vessel(imo, raw=False):
     resp = requests.get(f"{API_BASE_URL}/vessels/imo/{imo}", headers=HEADERS)
     resp.raise_for_status()
-    return resp.json()
+    return resp.content if raw else resp.json()
 
-def get_emission_sources_for_imo(imo):
+def get_emission_sources_for_imo(imo, raw=False):
     resp = requests.get(f"{EMISSION_SOURCES_URL}/vessel/{imo}", headers=HEADERS)
     resp.raise_for_status()
-    return resp.json()
+    return resp.content if raw else resp.json()
 
 def format_number(value):
     """Helper to format numeric values with thousand separators"""
@@ -651,33 +709,189 @@ def format_other_emission_sources(emission_sources, fired_boiler_method=""):
     return rows
 
 
-# ---------------- MAIN SCRIPT ----------------
-if SELECT_ONE_IMO:
-    imos = get_imos_for_company(CSV_FILE, vessel_imo=VESSEL_IMO)
-else:
-    imos = get_imos_for_company(CSV_FILE, company_name=COMPANY_NAME)
-for imo, csv_row in imos.items():
-    vessel = get_vessel(imo)
-    print(f"Processing vessel with IMO {imo}")
-    csv_dwg = csv_row.get("DWG NO.", "UNKNOWN")
-    placeholders = format_vessel_placeholder(vessel, csv_dwg)
+# ---------------- OUTPUT BUNDLE ----------------
+class FleetBundle:
+    """
+    Single zip/tar archive that rendered documents are streamed into as they
+    are produced. A manifest.csv (IMO, vessel name, DWG number, issue number)
+    is written when the bundle is closed.
+    The archive is written as <path>.part and only renamed to path by close(),
+    so a failed run never leaves a partial archive under the delivery name.
+    Only the parent process writes to the archive; entries follow the order
+    in which results come back from imap.
+    """
 
-    if SEEMP_VERSION_1_2:
-        process_docx(WORD_TEMPLATE, "temp.docx", placeholders)
+    MANIFEST_FIELDS = ["IMO", "VESSEL NAME", "DWG NO.", "ISSUE NO.", "FILE"]
+
+    def __init__(self, path, fmt="zip"):
+        if fmt not in ("zip", "tar"):
+            raise ValueError(f"Unknown bundle format: {fmt}")
+        self.path = path
+        self.part_path = f"{path}.part"
+        self.fmt = fmt
+        self.manifest = []
+        self.closed = False
+        if fmt == "zip":
+            self.archive = zipfile.ZipFile(self.part_path, "w")
+        else:
+            self.archive = tarfile.open(self.part_path, "w")
 
-        doc = Document("temp.docx")
+    def write_entry(self, arcname, data, compress_type):
+        if self.fmt == "zip":
+            self.archive.writestr(arcname, data, compress_type=compress_type)
+        else:
+            info = tarfile.TarInfo(arcname)
+            info.size = len(data)
+            info.mtime = time.time()
+            self.archive.addfile(info, io.BytesIO(data))
+
+    def add(self, arcname, data, manifest_row=None):
+        # docx and pdf are already compressed
+        self.write_entry(arcname, data, zipfile.ZIP_STORED)
+        if manifest_row is not None:
+            self.manifest.append({**manifest_row, "FILE": arcname})
+
+    def close(self):
+        out = io.StringIO()
+        writer = csv.DictWriter(out, fieldnames=self.MANIFEST_FIELDS)
+        writer.writeheader()
+        writer.writerows(sorted(self.manifest, key=lambda row: row["IMO"]))
+        self.write_entry("manifest.csv", out.getvalue().encode("utf-8"), zipfile.ZIP_DEFLATED)
+        self.archive.close()
+        os.replace(self.part_path, self.path)
+        self.closed = True
+
+    def abort(self):
+        """Discard the partial archive of a failed run"""
+        self.archive.close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+        self.closed = True
+
+
+def open_bundle(fmt):
+    name = VESSEL_IMO if SELECT_ONE_IMO else COMPANY_NAME
+    return FleetBundle(os.path.join(RESULTS_DIR, f"{name}.{fmt}"), fmt)
+
+
+# ---------------- TEMPLATE PRECOMPILATION ----------------
+def template_cache_key(template_path, flags):
+    """Hash of the cache version, the template bytes and the config flags"""
+    h = hashlib.sha256()
+    h.update(str(TEMPLATE_CACHE_VERSION).encode("utf-8"))
+    with open(template_path, "rb") as f:
+        h.update(f.read())
+    h.update(json.dumps(flags, sort_keys=True).encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+def prune_template_cache(stem, key):
+    """Delete cached variants of the same template that were built under another key"""
+    pattern = re.compile(rf"{re.escape(stem)}-[0-9a-f]{{16}}\.(docx|json)")
+    for file in os.listdir(TEMPLATE_CACHE_DIR):
+        if pattern.fullmatch(file) and not file.startswith(f"{stem}-{key}."):
+            os.remove(os.path.join(TEMPLATE_CACHE_DIR, file))
+
+
+def find_placeholder_slots(template_path):
+    """
+    Return {xml part: [placeholders]} for every part under word/
+    that still contains a {{...}} placeholder.
+    """
+    slots = {}
+    with zipfile.ZipFile(template_path, 'r') as zip_ref:
+        for name in zip_ref.namelist():
+            if not (name.startswith("word/") and name.endswith(".xml")):
+                continue
+            root = etree.fromstring(zip_ref.read(name))
+            text = "".join(t.text or "" for t in root.iter("{%s}t" % W_NS))
+            found = sorted(set(re.findall(r"\{\{[A-Z0-9_]+\}\}", text)))
+            if found:
+                slots[name] = found
+    return slots
+
+
+def bake_method(doc, method):
+    """Replace {{METHOD}} in the template row with the static fired boiler method"""
+    for table in doc.tables:
+        for row in table.rows:
+            for cell in row.cells:
+                if "{{METHOD}}" in cell.text:
+                    for paragraph in cell.paragraphs:
+                        replace_placeholder_preserve_format(paragraph, {"METHOD": method})
 
-        emission_sources = get_emission_sources_for_imo(imo)
 
-        fired_boiler_method = get_method_from_placeholder(doc)
+def precompile_template(template_path, flags):
+    """
+    Resolve everything that depends only on the template and the config flags
+    (issue number, {{BIO}} column, fired boiler method) and write a specialized
+    copy of the template to TEMPLATE_CACHE_DIR. The result is reused until the
+    template file, the flags or TEMPLATE_CACHE_VERSION change.
+    INCLUDE_WASTE_INCINERATOR is not a flag here: it filters emission sources,
+    which are vessel data, and does not change the compiled template.
+    """
+    key = template_cache_key(template_path, flags)
+    stem = os.path.splitext(os.path.basename(template_path))[0]
+    compiled_path = os.path.join(TEMPLATE_CACHE_DIR, f"{stem}-{key}.docx")
+    meta_path = os.path.join(TEMPLATE_CACHE_DIR, f"{stem}-{key}.json")
 
-        other_es_rows = format_other_emission_sources(emission_sources, fired_boiler_method)
+    if os.path.exists(compiled_path) and os.path.exists(meta_path):
+        with open(meta_path, encoding="utf-8") as f:
+            return json.load(f)
 
-        populate_table(doc, other_es_rows, ["{{ES}}", "{{METHOD}}"])
-        
-        issue_num = get_issue_number(doc)
+    prune_template_cache(stem, key)
 
+    doc = Document(template_path)
+    issue_num = get_issue_number(doc)
+    include_bio = False
+    fired_boiler_method = ""
+
+    if flags["SEEMP_VERSION_1_2"]:
         include_bio = has_bio(doc)
+        fired_boiler_method = get_method_from_placeholder(doc)
+
+    if fired_boiler_method:
+        bake_method(doc, fired_boiler_method)
+        doc.save(compiled_path)
+    else:
+        shutil.copyfile(template_path, compiled_path)
+
+    template = {
+        "path": compiled_path,
+        "flags": flags,
+        "issue_num": issue_num,
+        "include_bio": include_bio,
+        "fired_boiler_method": fired_boiler_method,
+        "method_baked": bool(fired_boiler_method),
+        "slots": find_placeholder_slots(compiled_path)
+    }
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(template, f, indent=2)
+    return template
+
+
+# ---------------- RENDERING ----------------
+def render_vessel(template, template_source, csv_row, vessel, emission_sources):
+    """
+    Render one vessel from the precompiled template.
+    Returns the output file name (without extension) and the docx bytes.
+    """
+    csv_dwg = csv_row.get("DWG NO.", "UNKNOWN")
+    placeholders = format_vessel_placeholder(vessel, csv_dwg)
+    issue_num = template["issue_num"]
+    include_bio = template["include_bio"]
+    output_doc = io.BytesIO()
+
+    if template["flags"]["SEEMP_VERSION_1_2"]:
+        rendered = io.BytesIO()
+        process_docx(template_source, rendered, placeholders, template["slots"])
+
+        doc = Document(rendered)
+
+        other_es_rows = format_other_emission_sources(emission_sources, template["fired_boiler_method"])
+
+        other_es_placeholders = ["{{ES}}"] if template["method_baked"] else ["{{ES}}", "{{METHOD}}"]
+        populate_table(doc, other_es_rows, other_es_placeholders)
 
         fuel_rows = format_fuel_types(emission_sources, include_bio)
 
@@ -692,22 +906,106 @@ for imo, csv_row in imos.items():
         populate_table(doc, emis_rows, emis_placeholders)
 
         output_filename = f"{csv_dwg} {vessel['vesselName']} – SEEMP I-II Issue No. {issue_num}"
-        doc.save(os.path.join(RESULTS_DIR, f"{output_filename}.docx"))
+        doc.save(output_doc)
 
-        if os.path.exists("temp.docx"):
-            os.remove("temp.docx")
-        
     else:
-        doc = Document(WORD_TEMPLATE)
-        issue_num = get_issue_number(doc)
-
         output_filename = f"{csv_dwg} {vessel['vesselName']} – SEEMP PART III Issue No. {issue_num}"
-        process_docx(WORD_TEMPLATE, os.path.join(RESULTS_DIR, f"{output_filename}.docx"), placeholders)
+        process_docx(template_source, output_doc, placeholders, template["slots"])
 
-    output_doc = os.path.join(RESULTS_DIR, f"{output_filename}.docx")
-    output_pdf = os.path.join(RESULTS_DIR, f"{output_filename}.pdf")
-    print(f"✅ Saved {output_filename}.docx")
-    
-    # Convert to PDF
-    # convert(output_doc, output_pdf)
-    # print(f"✅ Saved {output_filename}.pdf")
\ No newline at end of file
+    return output_filename, output_doc.getvalue()
+
+
+# ---------------- WORKER POOL ----------------
+worker_template = None
+worker_source = None
+
+def init_worker(template):
+    """Map the precompiled template once per worker process"""
+    global worker_template, worker_source
+    worker_template = template
+    worker_source = MappedTemplate(template["path"])
+
+
+def render_worker(task):
+    """
+    Decode the fetched JSON payloads and render one vessel.
+    Payloads arrive as the raw API response bytes rather than pickled dicts.
+    """
+    imo, csv_row, vessel_json, emission_json = task
+    vessel = json.loads(vessel_json)
+    emission_sources = json.loads(emission_json) if emission_json else []
+    output_filename, data = render_vessel(worker_template, worker_source, csv_row, vessel, emission_sources)
+    return imo, csv_row, vessel["vesselName"], output_filename, data
+
+
+def fetch_tasks(imos, with_emission_sources):
+    for imo, csv_row in imos.items():
+        vessel_json = get_vessel(imo, raw=True)
+        print(f"Processing vessel with IMO {imo}")
+        emission_json = get_emission_sources_for_imo(imo, raw=True) if with_emission_sources else b""
+        yield imo, csv_row, vessel_json, emission_json
+
+
+def save_results(results, bundle, template):
+    """Write rendered documents to the bundle, or to RESULTS_DIR if there is none"""
+    for imo, csv_row, vessel_name, output_filename, data in results:
+        if bundle:
+            bundle.add(f"{output_filename}.docx", data, {
+                "IMO": imo,
+                "VESSEL NAME": vessel_name,
+                "DWG NO.": csv_row.get("DWG NO.", "UNKNOWN"),
+                "ISSUE NO.": template["issue_num"]
+            })
+            print(f"✅ Added {output_filename}.docx to {bundle.path}")
+        else:
+            output_doc = os.path.join(RESULTS_DIR, f"{output_filename}.docx")
+            with open(output_doc, "wb") as f:
+                f.write(data)
+            print(f"✅ Saved {output_filename}.docx")
+
+            # Convert to PDF
+            # convert(output_doc, os.path.join(RESULTS_DIR, f"{output_filename}.pdf"))
+            # print(f"✅ Saved {output_filename}.pdf")
+
+
+# ---------------- MAIN SCRIPT ----------------
+if __name__ == "__main__":
+    token = authenticate(MYUSERNAME, MYPASSWORD)
+
+    HEADERS = {
+        "Authorization": f"Bearer {token}",
+        "Accept": "application/json"
+    }
+
+    template = precompile_template(WORD_TEMPLATE, {
+        "SEEMP_VERSION_1_2": SEEMP_VERSION_1_2
+    })
+
+    bundle = open_bundle(OUTPUT_BUNDLE) if OUTPUT_BUNDLE else None
+
+    if SELECT_ONE_IMO:
+        imos = get_imos_for_company(CSV_FILE, vessel_imo=VESSEL_IMO)
+    else:
+        imos = get_imos_for_company(CSV_FILE, company_name=COMPANY_NAME)
+
+    tasks = fetch_tasks(imos, SEEMP_VERSION_1_2)
+
+    # imap keeps the CSV order, so the bundle is the same whatever WORKERS is
+    try:
+        if WORKERS > 1:
+            with multiprocessing.Pool(WORKERS, initializer=init_worker, initargs=(template,)) as pool:
+                save_results(pool.imap(render_worker, tasks), bundle, template)
+        else:
+            init_worker(template)
+            try:
+                save_results(map(render_worker, tasks), bundle, template)
+            finally:
+                worker_source.close()
+
+        if bundle:
+            bundle.close()
+            print(f"✅ Saved {bundle.path}")
+    finally:
+        if bundle and not bundle.closed:
+            bundle.abort()
+            print(f"❌ Run failed, discarded {bundle.part_path}")